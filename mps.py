@@ -1,31 +1,35 @@
 import numpy as np
 from scipy.special import jv
-from scipy.spatial.distance import cdist
 import scipy.linalg as la
+from functools import lru_cache, wraps
+from collections import OrderedDict
 from utils import *
 
 def radii(x,y,x_v,y_v):
     """Computes the radial distance from each point in x,y to each polygon vertex in x_v, y_v.
     For use in evaluating Fourier-Bessel functions in the Method of Particular Solutions.
+    The result is column-major, so the distances to each vertex are contiguous.
     """
-    return cdist(np.array([x,y]).T,np.array([x_v,y_v]).T)
+    return np.hypot(x-x_v[:,np.newaxis],y-y_v[:,np.newaxis]).T
 
 def thetas(x,y,x_v,y_v):
     """Computes the angles between given points and the polygon edges which are
     counter-clockwise from the vertices (x_i,v_i). For use in evaluating Fourier-Bessel
-    functions in the Method of Particular Solutions."""
-    theta = np.zeros((len(x_v),len(x)))
-    dx_p = np.roll(x_v,-1)-x_v
-    dy_p = np.roll(y_v,-1)-y_v
-    for i in range(len(x_v)):
-        dx, dy = x-x_v[i], y-y_v[i]
-        theta[i] = np.arccos(1-cdist([[dx_p[i],dy_p[i]]],np.array([dx,dy]).T,'cosine'))
-        reentrant = (dx_p[i]*dy - dy_p[i]*dx)<0
-        theta[i][reentrant] = 2*np.pi - theta[i][reentrant]
+    functions in the Method of Particular Solutions. Like radii, the result is
+    column-major."""
+    dx_p, dy_p = polygon_edges(x_v,y_v)
+    dx_p, dy_p = dx_p[:,np.newaxis], dy_p[:,np.newaxis]
+    dx, dy = x-x_v[:,np.newaxis], y-y_v[:,np.newaxis]
+
+    # counter-clockwise angle from each edge to each point, in [0,2π). unlike arccos
+    # of the normalized dot product, this is accurate near 0 and π, so points on an
+    # edge get their exact angle rather than one that is off by about 1e-8
+    theta = np.arctan2(dx_p*dy-dy_p*dx,dx_p*dx+dy_p*dy)
+    theta[theta<0] += 2*np.pi
     return theta.T
 
 def build_A_lam(x_v,y_v,x_b,y_b,x_i,y_i,k):
-    """Constructs A(\lambda) for the Method of Particular Solutionsm given vertices
+    """Constructs A(λ) for the Method of Particular Solutionsm given vertices
     (x_v,y_v), boundary points (x_b,y_b), interior points (x_i,y_i), and expansion
     orders k = (k1,...,kn)"""
     if isinstance(x_v,list) or isinstance(y_v,list):
@@ -37,11 +41,6 @@ def build_A_lam(x_v,y_v,x_b,y_b,x_i,y_i,k):
     else:
         k = np.array(k,dtype='int')
 
-    n = len(x_v)
-    m_b = len(x_b)
-    m_i = len(x_i)
-    m = m_b + m_i
-
     # compute alphas
     alpha = np.pi/calc_angles(x_v,y_v)
 
@@ -53,37 +52,185 @@ def build_A_lam(x_v,y_v,x_b,y_b,x_i,y_i,k):
     r = radii(x,y,x_ve,y_ve)
     theta = thetas(x,y,x_v,y_v)[:,mask]
 
-    # set up evaluations of Fourier-Bessel
-    # first calculate the fourier part (independent of λ!)
-    alphak = [alphai*np.arange(1,ki+1) for alphai,ki in zip(alpha,k)]
-    fourier = np.empty((m,k.sum()))
-    cumk = np.concatenate(([0],np.cumsum(k)))
-    for i in range(n):
-        if k[i] > 0:
-            fourier[:,cumk[i]:cumk[i+1]] = np.sin(np.outer(theta[:,i],alphak[i]))
+    # set up evaluations of Fourier-Bessel with one column per corner and order,
+    # where corner is the index of each column's corner among those with expansions
+    corner = np.repeat(np.arange(mask.sum()),k[mask])
+    cumk = np.concatenate(([0],np.cumsum(k[mask])))
+    alphak_vec = (alpha[mask][corner]*(np.arange(cumk[-1])-cumk[corner]+1))[np.newaxis]
+
+    # the fourier part is independent of λ, so compute it for all corners at once.
+    # the tables are stored column-major so that A(λ) comes out in the layout LAPACK
+    # factors in place, rather than being copied on every call to sigma. gathering
+    # rows of the transposed (vertex-major) tables gives that layout directly
+    fourier = np.sin(theta.T[corner]*alphak_vec.T).T
 
     # set up evaluations of bessel part
-    alphak_vec = np.concatenate(alphak)[np.newaxis]
-    r_rep = np.repeat(r,k[mask],axis=1)
+    r_rep = r.T[corner].T
 
-    # define A(λ)
-    def A_lam(lambda_):
-        return jv(alphak_vec,np.sqrt(lambda_)*r_rep)*fourier
+    # define A(λ), only the bessel part is recomputed for each λ. an array of λ
+    # gives a stack of matrices along the leading axes. if out is given, A(λ) is
+    # written into it rather than a new array
+    def A_lam(lambda_,out=None):
+        sqrt_lam = np.sqrt(lambda_)[...,np.newaxis,np.newaxis]
+        A = np.multiply(sqrt_lam,r_rep,out=out)
+        jv(alphak_vec,A,out=A)
+        A *= fourier
+        return A
     return A_lam
 
-def sigma(lambda_,A_lam,m_b,tol=1e-16):
+@lru_cache
+def _gesdd_lwork(dtype,m,n):
+    """Workspace size for a singular-values-only gesdd call on an m x n matrix,
+    computed once per shape since A(λ) has the same shape for every λ"""
+    gesdd_lwork, = la.get_lapack_funcs(('gesdd_lwork',),dtype=dtype)
+    work,info = gesdd_lwork(m,n,compute_uv=0)
+    _check_info(info,'gesdd_lwork')
+
+    # the size comes back as a float in the working precision, which can round
+    # below the true integer in single precision, so step up before truncating
+    work = np.finfo(dtype).dtype.type(work)
+    return max(int(np.nextafter(work,np.inf)),1)
+
+@lru_cache
+def _workspace_query(name,dtype,m,n,n_c=None):
+    """Optimal workspace size for the LAPACK routine name (geqp3, orgqr or ormqr)
+    on an m x n matrix (applied to an m x n_c matrix for ormqr), found with an
+    lwork=-1 query once per shape"""
+    routine, = la.get_lapack_funcs((name,),dtype=dtype)
+    a = np.zeros((m,n),dtype=dtype,order='F')
+    tau = np.zeros(min(m,n),dtype=dtype)
+    if name == 'geqp3':
+        args = (a,)
+    elif name == 'orgqr':
+        args = (a,tau)
+    else:
+        args = ('L','T',a,tau,np.zeros((m,n_c),dtype=dtype,order='F'))
+    work,info = routine(*args,lwork=-1)[-2:]
+    return max(int(work[0].real),1)
+
+def _check_info(info,name):
+    """Raises for an illegal-argument error code returned by the LAPACK routine name"""
+    if info < 0:
+        raise ValueError(f"illegal value in argument {-info} of internal {name}")
+
+def svdvals(A):
+    """Computes the singular values of A (in descending order) with a direct call
+    to LAPACK's gesdd, skipping the wrapper overhead of la.svd. A may be overwritten."""
+    gesdd, = la.get_lapack_funcs(('gesdd',),(A,))
+    lwork = _gesdd_lwork(A.dtype,*A.shape)
+    _,s,_,info = gesdd(A,compute_uv=0,lwork=lwork,overwrite_a=1)
+    if info > 0:
+        raise la.LinAlgError("SVD did not converge")
+    _check_info(info,'gesdd')
+    return s
+
+def ulp_cache(bits=50,maxsize=1024):
+    """Decorator memoizing f(lambda_,A_lam,*args,**kwargs) with lambda_ truncated to
+    its leading bits of mantissa, so that optimizer probes which differ only in the
+    last few bits share one evaluation. The cache is stored on A_lam itself, so it
+    holds at most maxsize values per A_lam and is freed along with it. The remaining
+    arguments must be hashable."""
+    if not 0 <= bits <= 52:
+        raise ValueError(f"bits must be between 0 and 52, got {bits}")
+    mask = np.uint64(~((1<<(52-bits))-1) & 0xFFFFFFFFFFFFFFFF)
+    def decorator(f):
+        attr = f'_{f.__name__}_cache'
+        @wraps(f)
+        def wrapper(lambda_,A_lam,*args,**kwargs):
+            # optimizers may pass λ as a 1-element array. anything holding more than
+            # one value is passed through uncached
+            lam = np.asarray(lambda_,dtype=np.float64)
+            if lam.size != 1:
+                return f(lambda_,A_lam,*args,**kwargs)
+            lam = lam.reshape(())
+            lambda_ = float((lam.view(np.uint64) & mask).view(np.float64))
+            cache = A_lam.__dict__.setdefault(attr,OrderedDict())
+            key = (lambda_,args,tuple(sorted(kwargs.items())))
+            if key in cache:
+                cache.move_to_end(key)
+                return cache[key]
+            value = cache[key] = f(lambda_,A_lam,*args,**kwargs)
+            if len(cache) > maxsize:
+                cache.popitem(last=False)
+            return value
+        return wrapper
+    return decorator
+
+@ulp_cache()
+def sigma(lambda_,A_lam,m_b,tol=1e-16,gram=False):
     """Computes the smallest singular value of the submatrix of the column-pivoted
-    and thin QR factorization of A(\lambda) corresponding to the boundary points"""
-    A = A_lam(lambda_)
-    Q,R,P = la.qr(A, mode='economic', pivoting=True)
+    and thin QR factorization of A(λ) corresponding to the boundary points.
+    If gram is True, it is instead computed from the smallest eigenvalue of the smaller
+    of the Gram matrices Q_B^T Q_B and Q_B Q_B^T (see _gram_svmin). This is cheaper,
+    but only accurate to about the square root of machine precision, so it is best
+    suited to coarse sweeps rather than refinement."""
+    return _sigma(A_lam(lambda_),m_b,tol,gram)
+
+def sigmas(lambdas,A_lam,m_b,tol=1e-16,gram=False,batch_size=64):
+    """Computes sigma(λ) for each λ in lambdas. The matrices A(λ) are
+    built batch_size at a time with a single call to A_lam, amortizing the overhead
+    of evaluating the Fourier-Bessel functions over the whole batch."""
+    lambdas = np.atleast_1d(np.asarray(lambdas,dtype='float'))
+    s = np.empty(len(lambdas))
+    A = None
+    for start in range(0,len(lambdas),batch_size):
+        # reuse the previous batch's storage when the batch size allows
+        batch = lambdas[start:start+batch_size]
+        if A is not None and len(batch) == len(A):
+            A = A_lam(batch,out=A)
+        else:
+            A = A_lam(batch)
+        for i in range(len(A)):
+            s[start+i] = _sigma(A[i],m_b,tol,gram)
+    return s
+
+def _gram_svmin(Q_B):
+    """Computes the smallest singular value of Q_B from the smallest eigenvalue of
+    the smaller of its Gram matrices Q_B^T Q_B and Q_B Q_B^T. The larger one is
+    singular whenever Q_B is not square, so using it would always give zero."""
+    syrk, = la.get_blas_funcs(('syrk',),(Q_B,))
+    G = syrk(1.0,Q_B,trans=int(Q_B.shape[0] >= Q_B.shape[1]))
+    e = la.eigh(G,lower=False,eigvals_only=True,subset_by_index=[0,0],driver='evr')
+    return np.sqrt(max(e[0],0))
+
+def _sigma(A,m_b,tol,gram):
+    """Computes sigma for an already-evaluated A(λ)"""
+    # la.qr used to check this, but LAPACK silently produces garbage from infs or NaNs
+    if not np.isfinite(A).all():
+        raise ValueError("array must not contain infs or NaNs")
+    geqp3, orgqr, ormqr = la.get_lapack_funcs(('geqp3','orgqr','ormqr'),(A,))
+    qr,_,tau,_,info = geqp3(A,lwork=_workspace_query('geqp3',A.dtype,*A.shape),overwrite_a=1)
+    _check_info(info,'geqp3')
 
     # drop columns of Q corresponding to small diagonal entries of R
-    r = np.abs(np.diag(R))
+    r = np.abs(np.diag(qr))
     cutoff = (r>r[0]*tol).sum()
+    if cutoff == 0:
+        return np.inf
+
+    # form only the rows of Q for the boundary points and the columns which are
+    # kept. when there are fewer boundary points than kept columns, it is cheaper
+    # to apply Q^T to the first m_b columns of the identity than to form Q
+    m = A.shape[0]
+    if m_b < cutoff:
+        E = np.zeros((m,m_b),dtype=A.dtype,order='F')
+        E[:m_b] = np.eye(m_b)
+        lwork = _workspace_query('ormqr',A.dtype,m,cutoff,m_b)
+        QTE,_,info = ormqr('L','T',qr[:,:cutoff],tau[:cutoff],E,lwork,overwrite_c=1)
+        _check_info(info,'ormqr')
+        Q_B = QTE[:cutoff].T
+    else:
+        lwork = _workspace_query('orgqr',A.dtype,m,cutoff)
+        Q,_,info = orgqr(qr[:,:cutoff],tau[:cutoff],lwork=lwork,overwrite_a=1)
+        _check_info(info,'orgqr')
+        Q_B = Q[:m_b]
+
+    if gram:
+        return _gram_svmin(Q_B)
 
     # calculate and return smallest singular value
     try:
-        s = la.svd(Q[:m_b,:cutoff],compute_uv=False)[-1]
-    except:
+        s = svdvals(Q_B)[-1]
+    except la.LinAlgError:
         return np.inf
     return s
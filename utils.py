@@ -5,35 +5,53 @@ from shapely.geometry import Polygon
 from shapely import points
 from scipy.spatial.distance import cdist
 
+def polygon_edges(x,y):
+    """Computes the edge vectors (dx,dy) from each polygon vertex to the next, by
+    differencing slices of the vertex arrays rather than rolling them"""
+    x, y = np.asarray(x), np.asarray(y)
+    dx, dy = np.empty(len(x)), np.empty(len(y))
+    np.subtract(x[1:],x[:-1],out=dx[:-1])
+    np.subtract(y[1:],y[:-1],out=dy[:-1])
+    dx[-1], dy[-1] = x[0]-x[-1], y[0]-y[-1]
+    return dx, dy
+
 def calc_angles(x,y):
-    dx_p, dx_m = np.roll(x,-1)-x, np.roll(x,1)-x
-    dy_p, dy_m = np.roll(y,-1)-y, np.roll(y,1)-y
+    # the edge back to the previous vertex is the reversed previous edge
+    dx_p, dy_p = polygon_edges(x,y)
+    dx_m, dy_m = -np.roll(dx_p,1), -np.roll(dy_p,1)
 
-    theta = np.arccos((dx_p*dx_m+dy_p*dy_m)/np.sqrt((dx_p**2+dy_p**2)*(dx_m**2+dy_m**2)))
-    reentrant = (-dy_m*(dx_p-dx_m)+dx_m*(dy_p-dy_m))>0
-    theta[reentrant] = 2*np.pi - theta[reentrant]
+    # interior angle, measured counter-clockwise from the next edge to the previous
+    theta = np.arctan2(dx_p*dy_m-dy_p*dx_m,dx_p*dx_m+dy_p*dy_m)
+    theta[theta<0] += 2*np.pi
     return theta
 
 def calc_dists(x,y):
-    dx_p, dx_m = np.roll(x,1)-x, np.roll(x,-1)-x
-    dy_p, dy_m = np.roll(y,1)-y, np.roll(y,-1)-y
-
-    return (dx_p**2+dy_p**2)**0.5, (dx_m**2+dy_m**2)**0.5
+    # the distance to the previous vertex is the length of the previous edge
+    dx, dy = polygon_edges(x,y)
+    lens = (dx**2+dy**2)**0.5
+    return np.roll(lens,1), lens
 
 def seg_angles(x,y):
-    dx_m = np.roll(x,-1)-x
-    dy_m = np.roll(y,-1)-y
+    dx_m, dy_m = polygon_edges(x,y)
     return np.arctan2(dy_m,dx_m)
 
 def boundary_points(x,y,m,method='even',skip=None):
     mask = np.ones(len(x),dtype=bool)
     if skip is not None:
         mask[skip] = False
+    # place m points along each edge at fractions t/d of the way from its first
+    # vertex, excluding the vertices, one edge after another
     if method == 'even':
-        x_b = np.linspace(x,np.roll(x,-1),m+2)[1:-1,mask].flatten(order='F')
-        y_b = np.linspace(y,np.roll(y,-1),m+2)[1:-1,mask].flatten(order='F')
+        t, d = np.arange(1,m+1), m+1
     elif method == 'chebyshev':
-        pass
+        # chebyshev-gauss points in closed form, clustered toward the vertices
+        t, d = 1-np.cos((2*np.arange(1,m+1)-1)*np.pi/(2*m)), 2
+    else:
+        raise ValueError(f"unknown method '{method}'")
+    x, y = np.asarray(x), np.asarray(y)
+    dx, dy = polygon_edges(x,y)
+    x_b = ((dx/d)[mask,np.newaxis]*t + x[mask,np.newaxis]).ravel()
+    y_b = ((dy/d)[mask,np.newaxis]*t + y[mask,np.newaxis]).ravel()
     return x_b,y_b
 
 def interior_points(x,y,m,oversamp=10):
@@ -43,7 +61,7 @@ def interior_points(x,y,m,oversamp=10):
     y_i = (y_max-y_min)*np.random.rand(oversamp*m)+y_min
 
     poly = Polygon(np.array([x,y]).T)
-    pts = points(np.array([x_i,y_i]).T)
+    pts = points(x_i,y_i)
     mask = poly.contains(pts)
     if mask.sum() < m:
         return interior_points(x,y,oversamp=2*oversamp)
@@ -56,7 +74,7 @@ def interior_points_test(x,y,m,oversamp=10):
     y_i = (y_max-y_min)*np.random.rand(oversamp*m)+y_min
 
     poly = Polygon(np.array([x,y]).T)
-    pts = points(np.array([x_i,y_i]).T)
+    pts = points(x_i,y_i)
     mask = poly.contains(pts)
     return mask.sum()/(oversamp*m), m-mask.sum()
 
@@ -86,10 +104,7 @@ def random_polygon(n,r_avg,eps,sigma):
     u = np.random.rand(n)
     dtheta = (2*np.pi/n+eps)*u + (2*np.pi/n-eps)*(1-u)
     k = dtheta.sum()/(2*np.pi)
-    theta = np.zeros(n)
-    theta[0] = dtheta[0]/k
-    for i in range(1,n):
-        theta[i] = theta[i-1] + dtheta[i]/k
+    theta = np.cumsum(dtheta/k)
     r = sigma*np.random.randn(n)+r_avg
     r[r<0] = 0
     r[r>2*r_avg] = 2*r_avg